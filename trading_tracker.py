@@ -8,15 +8,33 @@ Uses Public.com History API for exact P&L calculation.
 
 import os
 import json
+import logging
 import re
 import copy
 import functools
+import heapq
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
 from flask import Flask, jsonify, send_file, request
-from requests import post, get
+from requests import Session
+from requests.adapters import HTTPAdapter
 
 app = Flask(__name__)
 
+# Debug tracing (e.g. the stock matcher in /api/debug/stock_trades) is emitted at DEBUG level;
+# set LOG_LEVEL=DEBUG to see it
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+_valid_log_level = isinstance(logging.getLevelName(LOG_LEVEL), int)
+logging.basicConfig(level=LOG_LEVEL if _valid_log_level else 'INFO')
+logger = logging.getLogger(__name__)
+if not _valid_log_level:
+    logger.warning("Unknown LOG_LEVEL %r, using INFO", LOG_LEVEL)
+
+# Responses are built in a meaningful order already; skip sorting every dict's keys on serialization
+app.json.sort_keys = False
+
 # ============================================================================
 # CORS ENABLEMENT
 # ============================================================================
@@ -34,6 +52,90 @@ def after_request(response):
 _history_cache = None
 _cache_time = None
 
+# Access tokens are requested with a 120 minute validity; reuse them until shortly before expiry
+TOKEN_VALIDITY_MINUTES = 120
+TOKEN_REFRESH_MARGIN_MINUTES = 10
+_access_token = None
+_token_time = None
+_account_id_cache = None  # (token, account_id)
+
+# One HTTP session for all Public API calls so TCP/TLS connections are kept alive.
+# Requests run on Flask's worker threads plus the portfolio prefetch thread, so keep
+# more than the default 10 idle connections to api.public.com around.
+_session = Session()
+_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=20))
+# (connect, read) seconds for every Public API call. The YTD recompute holds _pl_lock
+# across its requests, so a hung call must not stall every queued reader indefinitely.
+API_TIMEOUT = (5, 30)
+
+# Held while a forced /api/update refresh is running
+_update_lock = threading.Lock()
+# Held while the YTD P&L result is being recomputed
+_pl_lock = threading.Lock()
+
+# Raw History API responses, shared by calculate_pl_from_history and the debug endpoints
+HISTORY_FETCH_TTL = 60
+_history_fetches = {}  # (account_id, start, end) -> (fetched_at, response json)
+_history_fetches_lock = threading.Lock()
+
+# ============================================================================
+# OPTION SYMBOLS / TIMESTAMPS
+# ============================================================================
+
+# OCC option symbol: UNDERLYINGYYMMDD[CP]STRIKE, e.g. SOXL260102P00046500
+_OPTION_CONTRACT_RE = re.compile(r'([A-Z]+\d{6}[CP]\d{8})')
+_OPTION_PARTS_RE = re.compile(r'([A-Z]+)(\d{6})([CP])(\d{8})')
+# Stricter form used by the debug endpoints: expiry year must be 2020-2029
+_DEBUG_OPTION_CONTRACT_RE = re.compile(r'([A-Z]+2\d{2}\d{3}[CP]\d{8})')
+
+@functools.lru_cache(maxsize=4096)
+def parse_option_symbol(contract):
+    """Split an option contract into (underlying, YYMMDD expiry, 'CALL'/'PUT', strike)
+
+    Returns None if the symbol isn't in OCC format. Contracts repeat across
+    every fill, so results are memoized.
+    """
+    # Tickers and other short strings can't hold an underlying plus the 15-character tail
+    if len(contract) < 16:
+        return None
+
+    # The last 15 characters have a fixed layout (YYMMDD + C/P + 8-digit strike),
+    # so well-formed symbols can be split by position without the regex engine
+    underlying, tail = contract[:-15], contract[-15:]
+    if (underlying.isascii() and underlying.isalpha() and underlying.isupper()
+            and tail[:6].isdecimal() and tail[6] in 'CP' and tail[7:].isdecimal()):
+        return underlying, tail[:6], 'PUT' if tail[6] == 'P' else 'CALL', int(tail[7:]) / 1000
+
+    match = _OPTION_PARTS_RE.match(contract)
+    if not match:
+        return None
+    underlying, expiry, put_call, strike = match.groups()
+    return underlying, expiry, 'PUT' if put_call == 'P' else 'CALL', int(strike) / 1000  # Strike is in thousandths (00046500 = 46.50)
+
+def parse_timestamp(timestamp):
+    """Parse an API ISO-8601 timestamp (UTC 'Z' suffix) into an aware datetime"""
+    if timestamp.endswith('Z'):
+        timestamp = timestamp[:-1] + '+00:00'
+    return datetime.fromisoformat(timestamp)
+
+# ============================================================================
+# TRADE RECORDS
+# ============================================================================
+
+@dataclass(slots=True)
+class StockTrade:
+    """Stock trade (real or synthetic assignment BUY) fed to the debug LIFO matcher"""
+    symbol: str
+    side: str
+    quantity: int
+    amount: float
+    original_amount: float
+    cost_adjustment: float
+    adjusted: bool
+    timestamp: str
+    description: str
+    price_per_share: float = 0.0
+
 # ============================================================================
 # API KEY AUTHENTICATION
 # ============================================================================
@@ -64,48 +166,148 @@ def require_api_key(f):
 
 # ============================================================================
 
+def forget_access_token():
+    """Drop the cached access token and account id so the next call re-authenticates"""
+    global _access_token, _token_time, _account_id_cache
+    _access_token = None
+    _token_time = None
+    _account_id_cache = None
+
 def get_access_token():
-    """Get access token from Public API"""
+    """Get access token from Public API (cached until shortly before it expires)"""
+    global _access_token, _token_time
+
+    if _access_token and _token_time:
+        age = (datetime.now() - _token_time).total_seconds()
+        if age < (TOKEN_VALIDITY_MINUTES - TOKEN_REFRESH_MARGIN_MINUTES) * 60:
+            return _access_token
+
     secret = os.environ.get('PUBLIC_API_TOKEN')
     if not secret:
         raise Exception('PUBLIC_API_TOKEN not set')
 
-    response = post(
+    response = _session.post(
         'https://api.public.com/userapiauthservice/personal/access-tokens',
-        json={'secret': secret, 'validityInMinutes': 120},
-        headers={'Content-Type': 'application/json'}
+        json={'secret': secret, 'validityInMinutes': TOKEN_VALIDITY_MINUTES},
+        headers={'Content-Type': 'application/json'},
+        timeout=API_TIMEOUT
     )
-    return response.json()['accessToken']
+    if not response.ok:
+        forget_access_token()
+        raise Exception(f'Access token request failed ({response.status_code})')
+    _access_token = response.json()['accessToken']
+    _token_time = datetime.now()
+    return _access_token
 
 def get_account_id(token):
-    """Get brokerage account ID"""
-    response = get(
+    """Get brokerage account ID (cached per access token)"""
+    global _account_id_cache
+
+    if _account_id_cache and _account_id_cache[0] == token:
+        return _account_id_cache[1]
+
+    response = _session.get(
         'https://api.public.com/userapigateway/trading/account',
-        headers={'Authorization': f'Bearer {token}'}
+        headers={'Authorization': f'Bearer {token}'},
+        timeout=API_TIMEOUT
     )
+    if not response.ok:
+        # Most likely a revoked or expired token; fetch a new one next time
+        forget_access_token()
+        raise Exception(f'Account request failed ({response.status_code})')
     accounts = response.json().get('accounts', [])
+    account_id = None
     for acc in accounts:
         if acc.get('accountType') == 'BROKERAGE':
-            return acc['accountId']
-    return accounts[0]['accountId'] if accounts else None
+            account_id = acc['accountId']
+            break
+    else:
+        if accounts:
+            account_id = accounts[0]['accountId']
+
+    if account_id:
+        _account_id_cache = (token, account_id)
+    return account_id
 
 def fetch_order_history(token, account_id, start_date, end_date):
-    """Fetch order history from Public API"""
+    """Fetch order history from Public API (identical ranges are reused for HISTORY_FETCH_TTL seconds)"""
+    key = (account_id, start_date, end_date)
+    now = datetime.now()
+    cached = _history_fetches.get(key)
+    if cached and (now - cached[0]).total_seconds() < HISTORY_FETCH_TTL:
+        return cached[1]
+
     url = f"https://api.public.com/userapigateway/trading/{account_id}/history"
     params = {'start': start_date, 'end': end_date, 'pageSize': 1000}
-    response = get(url, params=params, headers={'Authorization': f'Bearer {token}'})
+    response = _session.get(url, params=params, headers={'Authorization': f'Bearer {token}'}, timeout=API_TIMEOUT)
+    if not response.ok:
+        # The cached token may have been revoked; don't mistake the error body for an empty history
+        forget_access_token()
+        raise Exception(f'History request failed ({response.status_code})')
+    history = response.json()
+
+    # Request threads and the background refresh share this dict
+    with _history_fetches_lock:
+        # Drop expired ranges (e.g. yesterday's) before storing the new one
+        for stale in [k for k, (fetched, _) in _history_fetches.items() if (now - fetched).total_seconds() >= HISTORY_FETCH_TTL]:
+            del _history_fetches[stale]
+        _history_fetches[key] = (now, history)
+    return history
+
+def fetch_portfolio(token, account_id):
+    """Fetch current portfolio positions from Public API"""
+    response = _session.get(
+        f'https://api.public.com/userapigateway/trading/{account_id}/portfolio',
+        headers={'Authorization': f'Bearer {token}'},
+        timeout=API_TIMEOUT
+    )
+    if not response.ok:
+        forget_access_token()
+        raise Exception(f'Portfolio request failed ({response.status_code})')
     return response.json()
 
+@functools.lru_cache(maxsize=1)
+def year_start_timestamp(year):
+    """Jan 1 00:00:00 UTC of the given year, formatted for the History API"""
+    return datetime(year, 1, 1).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def day_end_timestamp(now):
+    """23:59:59 on the day of `now` (a UTC datetime), formatted for the History API
+
+    Using the end of day rather than the current second keeps the range
+    stable across requests so fetch_order_history can reuse it.
+    """
+    return datetime(now.year, now.month, now.day, 23, 59, 59).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def _fresh_pl_cache():
+    """Cached YTD result if it is less than 5 minutes old, else None"""
+    if _history_cache and _cache_time:
+        age = (datetime.now() - _cache_time).total_seconds()
+        if age < 300:
+            return _history_cache
+    return None
+
 def calculate_pl_from_history(start_date=None, end_date=None):
     """Calculate P&L by tracking position state - CLEAN VERSION"""
-    global _history_cache, _cache_time
-
     # Cache only for default YTD call
-    if start_date is None and end_date is None:
-        if _history_cache and _cache_time:
-            age = (datetime.now() - _cache_time).total_seconds()
-            if age < 300:
-                return _history_cache
+    if start_date is not None or end_date is not None:
+        return _compute_pl_from_history(start_date, end_date)
+
+    cached = _fresh_pl_cache()
+    if cached:
+        return cached
+
+    # Concurrent cache misses (e.g. a dashboard poll during /api/update) wait
+    # for one recompute instead of each refetching from the API
+    with _pl_lock:
+        cached = _fresh_pl_cache()
+        if cached:
+            return cached
+        return _compute_pl_from_history(None, None)
+
+def _compute_pl_from_history(start_date, end_date):
+    """Fetch history and portfolio and compute P&L (uncached)"""
+    global _history_cache, _cache_time
 
     try:
         token = get_access_token()
@@ -113,34 +315,30 @@ def calculate_pl_from_history(start_date=None, end_date=None):
 
         now = datetime.now(timezone.utc)
         if start_date is None:
-            start_date = datetime(2026, 1, 1, 0, 0, 0, tzinfo=timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+            start_date = year_start_timestamp(now.year)
         if end_date is None:
-            end_date = datetime(now.year, now.month, now.day, 23, 59, 59, tzinfo=timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+            end_date = day_end_timestamp(now)
 
-        # Fetch YTD transactions
-        history = fetch_order_history(token, account_id, start_date, end_date)
-        transactions = history.get('transactions', [])
+        # Fetch portfolio (to check what's open) in the background while the
+        # YTD transactions are fetched, so the two requests overlap
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            portfolio_future = pool.submit(fetch_portfolio, token, account_id)
+            history = fetch_order_history(token, account_id, start_date, end_date)
+            transactions = history.get('transactions', [])
+            portfolio = portfolio_future.result()
 
-        # Fetch portfolio to check what's open
-        portfolio_response = get(
-            f'https://api.public.com/userapigateway/trading/{account_id}/portfolio',
-            headers={'Authorization': f'Bearer {token}'}
-        )
-        portfolio = portfolio_response.json()
-
-        # Get currently open symbols from portfolio
+        # Get currently open symbols and unrealized P&L (costBasis.gainValue) in one pass
         open_in_portfolio = set()
-        if 'positions' in portfolio:
-            for pos in portfolio['positions']:
-                instrument = pos.get('instrument', {})
-                symbol = instrument.get('symbol', '')
-                inst_type = instrument.get('type', '')
+        total_unrealized_pl = 0
+        for pos in portfolio.get('positions', []):
+            instrument = pos.get('instrument', {})
 
-                # For options: full symbol, for stocks: just symbol
-                if inst_type == 'OPTION':
-                    open_in_portfolio.add(symbol)
-                elif inst_type == 'EQUITY':
-                    open_in_portfolio.add(symbol)
+            # Options are keyed by full contract symbol, stocks by ticker - both are the instrument symbol
+            if instrument.get('type', '') in ('OPTION', 'EQUITY'):
+                open_in_portfolio.add(instrument.get('symbol', ''))
+
+            cost_basis = pos.get('costBasis', {})
+            total_unrealized_pl += float(cost_basis.get('gainValue', 0))
 
         # === Parse transactions ===
         option_contracts = {}  # contract -> {buy_total, sell_total, transactions, type}
@@ -158,20 +356,14 @@ def calculate_pl_from_history(start_date=None, end_date=None):
 
             # Check if option - format: UNDERLYINGYYMMDD[CP]STRIKE
             # Example: SOXL260102P00046500
-            option_match = re.search(r'([A-Z]+\d{6}[CP]\d{8})', description)
+            option_match = _OPTION_CONTRACT_RE.search(description)
             if option_match:
                 # Option - use full contract symbol
                 contract = option_match.group(1)
 
-                # Determine if it's a CALL or PUT
-                option_type = 'PUT' if 'P' in contract else 'CALL'
-
-                # Extract underlying symbol using regex
-                # Format: SYMBOLYYMMDD[CP]STRIKE
-                underlying_match = re.match(r'([A-Z]+)(\d{6})[CP]\d{8}', contract)
-                underlying = underlying_match.group(1) if underlying_match else contract[:4]  # Fallback to first 4 chars
-
                 if contract not in option_contracts:
+                    # Underlying and CALL/PUT from the contract symbol (SYMBOLYYMMDD[CP]STRIKE)
+                    underlying, _, option_type, _ = parse_option_symbol(contract)
                     option_contracts[contract] = {
                         'buy': 0,
                         'sell': 0,
@@ -193,21 +385,16 @@ def calculate_pl_from_history(start_date=None, end_date=None):
             else:
                 # Stock
                 parts = description.split()
-                if len(parts) >= 3:
+                if len(parts) >= 3 and parts[1].isdecimal():
                     side = 'BUY' if 'BUY' in description else 'SELL'
-                    try:
-                        qty = int(parts[1])
-                        symbol = parts[2]
-                        stock_trades.append({
-                            'symbol': symbol,
-                            'side': side,
-                            'quantity': qty,
-                            'amount': net_amount,
-                            'timestamp': timestamp,
-                            'description': description
-                        })
-                    except (ValueError, IndexError):
-                        continue
+                    stock_trades.append({
+                        'symbol': parts[2],
+                        'side': side,
+                        'quantity': int(parts[1]),
+                        'amount': net_amount,
+                        'timestamp': timestamp,
+                        'description': description
+                    })
 
         # === Calculate Assignment Premium Adjustments ===
         # Track put options that were assigned (short puts that expired/were assigned)
@@ -236,11 +423,11 @@ def calculate_pl_from_history(start_date=None, end_date=None):
                     # For puts, we sold them, so sell is negative
                     total_premium = abs(data['sell'])
 
-                    # Parse contract to get strike
+                    # Parse contract to get strike and expiration
                     # Format: SYMBOLYYMMDD[CP]STRIKE
-                    strike_match = re.search(r'[CP](\d{8})$', contract)
-                    if strike_match:
-                        strike_price = float(strike_match.group(1)) / 1000  # Strike is in cents (e.g., 00046500 = 46.50)
+                    parsed = parse_option_symbol(contract)
+                    if parsed:
+                        _, expiry, _, strike_price = parsed
                         underlying = data['underlying']
 
                         # Estimate number of contracts from premium
@@ -259,35 +446,32 @@ def calculate_pl_from_history(start_date=None, end_date=None):
                                         pass
 
                         if total_contracts > 0:
-                            # Extract expiration date from contract
-                            # Format: SYMBOLYYMMDD[CP]STRIKE
-                            exp_match = re.match(r'[A-Z]+(\d{6})[CP]\d{8}', contract)
-                            if exp_match:
-                                exp_date_str = '20' + exp_match.group(1)  # YY -> 20YY
-                                exp_year = int(exp_date_str[:4])
-                                exp_month = int(exp_date_str[4:6])
-                                exp_day = int(exp_date_str[6:8])
-                                try:
-                                    exp_date = datetime(exp_year, exp_month, exp_day, tzinfo=timezone.utc)
-
-                                    # Premium per share = total_premium / (contracts * 100)
-                                    premium_per_share = total_premium / (total_contracts * 100)
-                                    # Adjusted cost basis = strike - premium_per_share
-                                    adjusted_cost = strike_price - premium_per_share
-
-                                    if underlying not in assignment_adjustments:
-                                        assignment_adjustments[underlying] = []
-                                    assignment_adjustments[underlying].append({
-                                        'strike': strike_price,
-                                        'premium': total_premium,
-                                        'contracts': total_contracts,
-                                        'shares': total_contracts * 100,
-                                        'adjusted_cost': adjusted_cost,
-                                        'contract': contract,
-                                        'expiration': exp_date
-                                    })
-                                except ValueError:
-                                    pass  # Invalid date, skip
+                            # Expiration date from the parsed contract (YYMMDD)
+                            exp_date_str = '20' + expiry  # YY -> 20YY
+                            exp_year = int(exp_date_str[:4])
+                            exp_month = int(exp_date_str[4:6])
+                            exp_day = int(exp_date_str[6:8])
+                            try:
+                                exp_date = datetime(exp_year, exp_month, exp_day, tzinfo=timezone.utc)
+
+                                # Premium per share = total_premium / (contracts * 100)
+                                premium_per_share = total_premium / (total_contracts * 100)
+                                # Adjusted cost basis = strike - premium_per_share
+                                adjusted_cost = strike_price - premium_per_share
+
+                                if underlying not in assignment_adjustments:
+                                    assignment_adjustments[underlying] = []
+                                assignment_adjustments[underlying].append({
+                                    'strike': strike_price,
+                                    'premium': total_premium,
+                                    'contracts': total_contracts,
+                                    'shares': total_contracts * 100,
+                                    'adjusted_cost': adjusted_cost,
+                                    'contract': contract,
+                                    'expiration': exp_date
+                                })
+                            except ValueError:
+                                pass  # Invalid date, skip
 
         # === Calculate Option P&L ===
         options_pl = 0
@@ -333,23 +517,24 @@ def calculate_pl_from_history(start_date=None, end_date=None):
                 stock_positions[symbol] = []
 
             if trade['side'] == 'BUY':
-                # Parse buy timestamp
-                try:
-                    buy_date = datetime.fromisoformat(trade['timestamp'].replace('Z', '+00:00'))
-                except:
-                    buy_date = datetime.now(timezone.utc)
-
                 # Check if this buy matches an assignment quantity
                 # Mark it with assignment info if applicable
                 buy_lot = {
                     'quantity': trade['quantity'],
                     'amount': trade['amount'],
+                    'price_per_share': abs(trade['amount']) / trade['quantity'] if trade['quantity'] > 0 else 0,  # Fixed for the lot; quantity shrinks as it is sold
                     'timestamp': trade['timestamp'],
                     'description': trade['description']
                 }
 
                 # Check if this buy is from an assignment (check timing)
                 if symbol in assignment_adjustments:
+                    # Buy date is only needed to match assignments, so parse it here
+                    try:
+                        buy_date = parse_timestamp(trade['timestamp'])
+                    except (ValueError, AttributeError):  # Malformed or missing timestamp
+                        buy_date = datetime.now(timezone.utc)
+
                     for i, adj in enumerate(assignment_adjustments[symbol]):
                         adj_key = f"{symbol}_{adj['contract']}_{i}"
                         if adj_key not in used_assignments and trade['quantity'] == adj['shares']:
@@ -366,10 +551,12 @@ def calculate_pl_from_history(start_date=None, end_date=None):
                 stock_positions[symbol].append(buy_lot)
             else:  # SELL
                 remaining_qty = trade['quantity']
+                sell_price = abs(trade['amount']) / trade['quantity'] if trade['quantity'] > 0 else 0
+                lots = stock_positions[symbol]
 
                 # Match against open positions using LIFO (take from end)
-                while remaining_qty > 0 and stock_positions[symbol]:
-                    buy_lot = stock_positions[symbol][-1]  # LIFO: most recent
+                while remaining_qty > 0 and lots:
+                    buy_lot = lots[-1]  # LIFO: most recent
 
                     match_qty = min(remaining_qty, buy_lot['quantity'])
 
@@ -379,12 +566,10 @@ def calculate_pl_from_history(start_date=None, end_date=None):
                         # Use adjusted cost basis
                         adj = buy_lot['assignment_adjustment']
                         buy_price = adj['adjusted_cost']
-                        match_pl = (abs(trade['amount']) / trade['quantity'] - buy_price) * match_qty
                     else:
                         # Use actual buy price
-                        buy_price = abs(buy_lot['amount']) / buy_lot['quantity']
-                        sell_price = abs(trade['amount']) / trade['quantity']
-                        match_pl = (sell_price - buy_price) * match_qty
+                        buy_price = buy_lot['price_per_share']
+                    match_pl = (sell_price - buy_price) * match_qty
 
                     stocks_pl += match_pl
 
@@ -403,29 +588,10 @@ def calculate_pl_from_history(start_date=None, end_date=None):
 
                     # Remove fully used lots
                     if buy_lot['quantity'] == 0:
-                        stock_positions[symbol].pop()
-
-        # Calculate MTD from completed transactions
-        now_dt = datetime.now(timezone.utc)
-        current_month = now_dt.month
-        current_year = now_dt.year
-
-        mtd_realized_pl = sum(
-            tx['netAmount'] for tx in completed_transactions
-            if datetime.fromisoformat(tx['timestamp'].replace('Z', '+00:00')).month == current_month
-            and datetime.fromisoformat(tx['timestamp'].replace('Z', '+00:00')).year == current_year
-        )
+                        lots.pop()
 
         ytd_realized_pl = stocks_pl + options_pl
 
-        # Calculate unrealized P&L from costBasis.gainValue
-        total_unrealized_pl = 0
-        if 'positions' in portfolio:
-            for pos in portfolio['positions']:
-                cost_basis = pos.get('costBasis', {})
-                unrealized = float(cost_basis.get('gainValue', 0))
-                total_unrealized_pl += unrealized
-
         result = {
             'total_realized_pl': ytd_realized_pl,
             'stocks_pl': stocks_pl,
@@ -459,12 +625,18 @@ def get_stats():
     if 'error' in ytd_data:
         return ytd_data
 
+    # The rollups below are stored on the cached YTD result, so only the
+    # first call after a refresh has to walk the transactions
+    if 'mtd_closed' in ytd_data:
+        return ytd_data
+
     # Calculate MTD based on positions that CLOSED in the current month
     # Each transaction in completed_transactions represents a closed position
     # Use the transaction's timestamp as the closing date
+    # ISO 8601 timestamps start with YYYY-MM, so a prefix test selects the
+    # current month without parsing every timestamp
     now = datetime.now(timezone.utc)
-    current_month = now.month
-    current_year = now.year
+    month_prefix = now.strftime('%Y-%m')
 
     mtd_realized_pl = 0
     mtd_closed = 0
@@ -474,17 +646,10 @@ def get_stats():
     # Simply sum all transactions that closed in the current month
     # Each transaction already represents a complete closed position
     for tx in transactions:
-        timestamp = tx.get('timestamp', '')
-        net_amount = tx.get('netAmount', 0)
-
-        if timestamp:
-            try:
-                dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-                if dt.month == current_month and dt.year == current_year:
-                    mtd_realized_pl += net_amount
-                    mtd_closed += 1
-            except:
-                pass
+        timestamp = tx.get('timestamp') or ''
+        if timestamp.startswith(month_prefix):
+            mtd_realized_pl += tx.get('netAmount', 0)
+            mtd_closed += 1
 
     ytd_realized_pl = ytd_data['total_realized_pl']
 
@@ -509,6 +674,14 @@ def get_trades(days=7):
         return data['transactions'][:50]
     return []
 
+def clear_caches():
+    """Drop the cached P&L result and memoized History API responses"""
+    global _history_cache, _cache_time
+    _history_cache = None
+    _cache_time = None
+    with _history_fetches_lock:
+        _history_fetches.clear()
+
 # API Routes
 @app.route('/')
 @require_api_key
@@ -519,7 +692,10 @@ def index():
 @require_api_key
 def stats():
     """Get trading statistics"""
-    return jsonify(get_stats())
+    # Stats only change when the cache refreshes; let dashboard polls revalidate with an ETag
+    response = jsonify(get_stats())
+    response.add_etag()
+    return response.make_conditional(request)
 
 @app.route('/api/trades')
 @require_api_key
@@ -528,22 +704,33 @@ def trades():
     days = int(request.args.get('days', 7))
     return jsonify(get_trades(days))
 
+def _refresh_in_background():
+    """Recompute P&L from fresh API data, then let the next /api/update start"""
+    try:
+        result = calculate_pl_from_history()
+        if 'error' in result:
+            logger.warning("Background refresh failed: %s", result['error'])
+    finally:
+        _update_lock.release()
+
 @app.route('/api/update')
 @require_api_key
 def update():
-    """Force refresh"""
-    global _history_cache, _cache_time
-    _history_cache = None
-    _cache_time = None
-    return jsonify(calculate_pl_from_history())
+    """Force refresh in the background; /api/stats serves the new data once it's ready"""
+    # Concurrent clicks collapse into the refresh that is already running
+    if not _update_lock.acquire(blocking=False):
+        return jsonify({'status': 'in_progress'})
+    # Clear before returning so the dashboard's follow-up /api/stats can't get the stale result
+    clear_caches()
+    threading.Thread(target=_refresh_in_background, daemon=True).start()
+    return jsonify({'status': 'started'})
 
 @app.route('/api/reset')
 @require_api_key
 def reset():
     """Reset cache"""
-    global _history_cache, _cache_time
-    _history_cache = None
-    _cache_time = None
+    clear_caches()
+    forget_access_token()
     return jsonify({'status': 'reset'})
 
 @app.route('/api/health')
@@ -559,25 +746,22 @@ def health():
 @require_api_key
 def debug_stock_trades():
     """Debug endpoint to trace through stock FIFO matching with assignment adjustments"""
-    print("DEBUG: Endpoint called!")
+    logger.debug("debug_stock_trades called")
     try:
-        print("DEBUG: About to get token")
         token = get_access_token()
         account_id = get_account_id(token)
 
-        now = datetime.now()
-        year_start = datetime(now.year, 1, 1).strftime('%Y-%m-%dT%H:%M:%SZ')
-        end_date = now.strftime('%Y-%m-%dT%H:%M:%SZ')
-
-        history = fetch_order_history(token, account_id, year_start, end_date)
-        transactions = history.get('transactions', [])
+        now = datetime.now(timezone.utc)
+        year_start = year_start_timestamp(now.year)
+        end_date = day_end_timestamp(now)
+        now_iso = now.strftime('%Y-%m-%dT%H:%M:%SZ')
 
-        # Get portfolio
-        portfolio_response = get(
-            f'https://api.public.com/userapigateway/trading/{account_id}/portfolio',
-            headers={'Authorization': f'Bearer {token}'}
-        )
-        portfolio = portfolio_response.json()
+        # Get portfolio in the background while history is fetched
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            portfolio_future = pool.submit(fetch_portfolio, token, account_id)
+            history = fetch_order_history(token, account_id, year_start, end_date)
+            transactions = history.get('transactions', [])
+            portfolio = portfolio_future.result()
 
         # Check for stock symbols in portfolio
         stock_symbols_in_portfolio = set()
@@ -601,10 +785,10 @@ def debug_stock_trades():
             description = tx.get('description', '')
             timestamp = tx.get('timestamp', '')
 
-            match = re.search(r'([A-Z]+2\d{2}\d{3}[CP]\d{8})', description)
+            match = _DEBUG_OPTION_CONTRACT_RE.search(description)
             if match:
                 contract = match.group(1)
-                m2 = re.match(r'([A-Z]+)(\d{6})([CP])(\d{8})', contract)
+                m2 = _OPTION_PARTS_RE.match(contract)
                 if m2:
                     key = f"{m2.group(1)}_{m2.group(2)}"
                 else:
@@ -613,7 +797,7 @@ def debug_stock_trades():
                 if key not in option_trades:
                     option_trades[key] = {'buy': 0, 'sell': 0, 'transactions': []}
 
-                if 'BUY' in description:
+                if description.startswith('BUY'):
                     option_trades[key]['buy'] += net_amount
                 else:
                     option_trades[key]['sell'] += net_amount
@@ -642,7 +826,7 @@ def debug_stock_trades():
                             price = float(price_str)
 
                             # Format: UNDERLYINGYYMMDD(C/P)STRIKE*1000 (YYMMDD is 6 digits, NO separate version digit)
-                            m = re.match(r'([A-Z]+)(\d{6})([CP])(\d{8})', option_symbol)
+                            m = _OPTION_PARTS_RE.match(option_symbol)
                             if m:
                                 underlying = m.group(1)
                                 strike = int(m.group(4)) / 1000  # Convert from cents
@@ -666,8 +850,7 @@ def debug_stock_trades():
                             continue
 
         # Calculate premium per share
-        for symbol in assignment_adjustments:
-            adj = assignment_adjustments[symbol]
+        for adj in assignment_adjustments.values():
             if adj['quantity'] > 0:
                 adj['premium_per_share'] = adj['premium_total'] / adj['quantity']
 
@@ -684,22 +867,30 @@ def debug_stock_trades():
             timestamp = tx.get('timestamp', '')
 
             # Skip options
-            if re.search(r'([A-Z]+2\d{2}\d{3}[CP]\d{8})', description):
+            if _DEBUG_OPTION_CONTRACT_RE.search(description):
+                continue
+
+            # Descriptions lead with the side token, so a prefix test is enough
+            if description.startswith('BUY'):
+                side = 'BUY'
+            elif description.startswith('SELL'):
+                side = 'SELL'
+            else:
                 continue
 
             parts = description.split()
-            if len(parts) >= 3 and ('BUY' in description or 'SELL' in description):
-                side = 'BUY' if 'BUY' in description else 'SELL'
-                try:
-                    qty = int(parts[1])
-                except:
+            if len(parts) >= 3:
+                # Malformed quantities are skipped without raising
+                if not parts[1].isdecimal():
                     continue
+                qty = int(parts[1])
                 symbol = parts[2]
 
                 amount = net_amount
                 original_amount = amount
                 cost_adjustment = 0
                 adjusted = False
+                price_per_share = abs(amount / qty) if qty > 0 else 0
 
                 # Skip raw BUY trades that correspond to assignments.
                 # When a put is assigned, Schwab API creates both:
@@ -708,135 +899,141 @@ def debug_stock_trades():
                 # We skip the raw BUY since the synthetic trade already represents it correctly.
                 if side == 'BUY' and symbol in assignment_adjustments:
                     adj = assignment_adjustments[symbol]
-                    # Calculate price from this raw trade
-                    price_per_share = abs(amount / qty) if qty > 0 else 0
                     # Check if this raw trade matches the assignment parameters
                     if (qty == adj['quantity'] and
                         abs(price_per_share - adj['strike']) < 0.01):  # Allow small floating point diff
-                        print(f"DEBUG: Skipping raw BUY trade for {symbol} assignment: {qty} shares @ ${price_per_share:.2f} matches strike ${adj['strike']:.2f}")
+                        logger.debug("Skipping raw BUY trade for %s assignment: %s shares @ $%.2f matches strike $%.2f",
+                                     symbol, qty, price_per_share, adj['strike'])
                         continue  # Skip this raw BUY trade
 
                 # NOTE: Don't apply assignment adjustment to remaining raw BUY trades here.
                 # The synthetic trade generation below will create the correct assignment trades.
                 # Applying adjustment here would incorrectly mark existing BUY trades as adjusted.
 
-                stock_trades.append({
-                    'symbol': symbol,
-                    'side': side,
-                    'quantity': qty,
-                    'amount': amount,
-                    'original_amount': original_amount,
-                    'cost_adjustment': cost_adjustment,
-                    'adjusted': adjusted,
-                    'timestamp': timestamp,
-                    'description': description
-                })
+                stock_trades.append(StockTrade(
+                    symbol=symbol,
+                    side=side,
+                    quantity=qty,
+                    amount=amount,
+                    original_amount=original_amount,
+                    cost_adjustment=cost_adjustment,
+                    adjusted=adjusted,
+                    timestamp=timestamp,
+                    description=description,
+                    price_per_share=price_per_share
+                ))
 
         # Sort by timestamp
-        stock_trades.sort(key=lambda x: x['timestamp'])
+        stock_trades.sort(key=lambda x: x.timestamp)
 
         # Generate synthetic BUY trades for assignments with correct quantity
         # When a put is assigned, Schwab doesn't create a proper "BUY X shares" transaction,
         # so we directly create synthetic trades from assignment_adjustments data
         # Find the timestamp of the corresponding SELL trade to place the synthetic BUY nearby
-        print(f"DEBUG: assignment_adjustments = {assignment_adjustments}")
-        for symbol, adj in assignment_adjustments.items():
-            print(f"DEBUG: Creating synthetic BUY trade for {symbol} assignment: {adj}")
-
-            # Find the first SELL trade for this symbol to get a nearby timestamp
-            nearby_timestamp = None
-            for trade in stock_trades:
-                if trade['symbol'] == symbol and trade['side'] == 'SELL':
-                    nearby_timestamp = trade['timestamp']
-                    break
-
-            # If no SELL trade found, use current time
-            if not nearby_timestamp:
-                nearby_timestamp = datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ')
+        logger.debug("assignment_adjustments = %s", assignment_adjustments)
 
-            # Create the synthetic BUY trade with correct quantity and premium adjustment
-            original_cost = adj['quantity'] * adj['strike']  # Cost at strike price
-            adjusted_cost = original_cost - adj['premium_total']  # Premium reduces cost basis
-
-            synthetic_trade = {
-                'symbol': symbol,
-                'side': 'BUY',
-                'quantity': adj['quantity'],
-                'amount': -adjusted_cost,  # BUY trades have negative amounts (cash outflow)
-                'original_amount': -original_cost,
-                'cost_adjustment': adj['premium_total'],
-                'adjusted': True,
-                'timestamp': nearby_timestamp,
-                'description': f"BUY {adj['quantity']} {symbol} at ${adj['strike']:.2f} (assignment from put, adj=${adj['premium_total']:.2f})"
-            }
+        # First SELL timestamp per symbol, from one pass over the sorted trades
+        first_sell_timestamps = {}
+        for trade in stock_trades:
+            if trade.side == 'SELL' and trade.symbol not in first_sell_timestamps:
+                first_sell_timestamps[trade.symbol] = trade.timestamp
 
-            print(f"DEBUG: Created synthetic trade: qty={synthetic_trade['quantity']}, amount={synthetic_trade['amount']}, adj=${synthetic_trade['cost_adjustment']}")
-            stock_trades.append(synthetic_trade)
-            # Verify the trade was added correctly
-            print(f"DEBUG: After append, last trade in stock_trades has qty={stock_trades[-1]['quantity']}")
+        synthetic_trades = []
+        for symbol, adj in assignment_adjustments.items():
+            logger.debug("Creating synthetic BUY trade for %s assignment: %s", symbol, adj)
 
-        # Re-sort after adding synthetic trades
-        stock_trades.sort(key=lambda x: x['timestamp'])
+            # Use the first SELL trade for this symbol as a nearby timestamp,
+            # falling back to the request time if there is none
+            nearby_timestamp = first_sell_timestamps.get(symbol) or now_iso
 
-        # FIFO matching - use a deep copy for processing to preserve original trade quantities for display
-        stock_trades_copy = copy.deepcopy(stock_trades)
+            # Create the synthetic BUY trade with correct quantity and premium adjustment
+            quantity, strike, premium_total = adj['quantity'], adj['strike'], adj['premium_total']
+            original_cost = quantity * strike  # Cost at strike price
+            adjusted_cost = original_cost - premium_total  # Premium reduces cost basis
+
+            synthetic_trade = StockTrade(
+                symbol=symbol,
+                side='BUY',
+                quantity=quantity,
+                amount=-adjusted_cost,  # BUY trades have negative amounts (cash outflow)
+                original_amount=-original_cost,
+                cost_adjustment=premium_total,
+                adjusted=True,
+                timestamp=nearby_timestamp,
+                description=f"BUY {quantity} {symbol} at ${strike:.2f} (assignment from put, adj=${premium_total:.2f})",
+                price_per_share=adjusted_cost / quantity if quantity > 0 else 0
+            )
+
+            logger.debug("Created synthetic trade: qty=%s, amount=%s, adj=$%s",
+                         synthetic_trade.quantity, synthetic_trade.amount, synthetic_trade.cost_adjustment)
+            synthetic_trades.append(synthetic_trade)
+
+        # Merge the (few) synthetic trades into the already-sorted list instead of re-sorting it.
+        # heapq.merge is stable across inputs, so ties keep real trades ahead of synthetic ones.
+        synthetic_trades.sort(key=lambda x: x.timestamp)
+        stock_trades = list(heapq.merge(stock_trades, synthetic_trades, key=lambda x: x.timestamp))
+
+        # FIFO matching - work on copies to preserve original trade quantities for display
+        # (all StockTrade fields are scalars, so a shallow copy is enough)
+        stock_trades_copy = [copy.copy(t) for t in stock_trades]
         stock_positions = {}
         fifo_log = []
         stocks_pl = 0
 
-        # DEBUG: Log all trade quantities before FIFO
-        print(f"DEBUG: Before FIFO - trade quantities:")
-        for i, t in enumerate(stock_trades):
-            is_synth = " [SYNTHETIC]" if t.get('adjusted') else ""
-            print(f"  {i}. {t['side']} {t['symbol']}: qty={t['quantity']}{is_synth}")
+        # Log all trade quantities before FIFO (skipped entirely unless DEBUG is enabled)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Before FIFO - trade quantities:")
+            for i, t in enumerate(stock_trades):
+                logger.debug("  %d. %s %s: qty=%s%s", i, t.side, t.symbol, t.quantity, " [SYNTHETIC]" if t.adjusted else "")
 
         for trade in stock_trades_copy:
-            symbol = trade['symbol']
+            symbol = trade.symbol
             if symbol not in stock_positions:
                 stock_positions[symbol] = []
 
             log_entry = {
                 'trade': trade,
-                'action': 'added_to_queue' if trade['side'] == 'BUY' else 'matching',
+                'action': 'added_to_queue' if trade.side == 'BUY' else 'matching',
                 'before_queue': len(stock_positions.get(symbol, [])),
                 'matches': []
             }
 
-            if trade['side'] == 'BUY':
+            if trade.side == 'BUY':
                 stock_positions[symbol].append(trade)
                 log_entry['after_queue'] = len(stock_positions[symbol])
                 # Debug SOXL assignment
-                if symbol == 'SOXL' and trade['quantity'] == 2000:
-                    print(f"DEBUG SOXL BUY: Added to queue")
-                    print(f"  Amount: ${trade['amount']}")
-                    print(f"  Cost basis source: {trade.get('cost_basis_source', 'None')}")
+                if symbol == 'SOXL' and trade.quantity == 2000:
+                    logger.debug("SOXL BUY added to queue: amount=$%s, cost adjustment=$%s", trade.amount, trade.cost_adjustment)
             else:
-                remaining_qty = trade['quantity']
-                sell_price = abs(trade['amount'] / trade['quantity']) if trade['quantity'] > 0 else 0
-                print(f"DEBUG: LIFO - SELL {trade['quantity']} {symbol} @ ${sell_price:.2f} -> matching against {len(stock_positions[symbol])} BUY positions")
-
-                while remaining_qty > 0 and stock_positions[symbol]:
-                    buy_trade = stock_positions[symbol][-1]  # LIFO: take most recent BUY
-                    match_qty = min(remaining_qty, buy_trade['quantity'])
-                    buy_price = abs(buy_trade['amount'] / buy_trade['quantity']) if buy_trade['quantity'] > 0 else 0
+                remaining_qty = trade.quantity
+                sell_price = trade.price_per_share
+                logger.debug("LIFO - SELL %s %s @ $%.2f -> matching against %d BUY positions",
+                             trade.quantity, symbol, sell_price, len(stock_positions[symbol]))
+
+                queue = stock_positions[symbol]
+                while remaining_qty > 0 and queue:
+                    buy_trade = queue[-1]  # LIFO: take most recent BUY
+                    match_qty = min(remaining_qty, buy_trade.quantity)
+                    buy_price = buy_trade.price_per_share
                     match_pl = (sell_price - buy_price) * match_qty
                     stocks_pl += match_pl
-                    is_synth = " [SYNTHETIC]" if buy_trade.get('adjusted') else ""
-                    print(f"  MATCH: {match_qty} shares @ sell=${sell_price:.2f} vs buy=${buy_price:.2f}{is_synth} -> P&L=${match_pl:.2f} (running total: ${stocks_pl:.2f})")
+                    logger.debug("  MATCH: %s shares @ sell=$%.2f vs buy=$%.2f%s -> P&L=$%.2f (running total: $%.2f)",
+                                 match_qty, sell_price, buy_price, " [SYNTHETIC]" if buy_trade.adjusted else "",
+                                 match_pl, stocks_pl)
 
                     log_entry['matches'].append({
                         'match_qty': match_qty,
                         'sell_price': sell_price,
                         'buy_price': buy_price,
                         'match_pl': match_pl,
-                        'buy_description': buy_trade['description']
+                        'buy_description': buy_trade.description
                     })
 
                     remaining_qty -= match_qty
-                    buy_trade['quantity'] -= match_qty
+                    buy_trade.quantity -= match_qty
 
-                    if buy_trade['quantity'] == 0:
-                        stock_positions[symbol].pop()  # LIFO: remove from end
+                    if buy_trade.quantity == 0:
+                        queue.pop()  # LIFO: remove from end
 
                 if remaining_qty > 0:
                     log_entry['unmatched'] = remaining_qty
@@ -844,26 +1041,28 @@ def debug_stock_trades():
             log_entry['after_queue'] = len(stock_positions.get(symbol, []))
             fifo_log.append(log_entry)
 
-        # DEBUG: Log all trade quantities after FIFO
-        print(f"DEBUG: After FIFO - trade quantities:")
-        for i, t in enumerate(stock_trades):
-            is_synth = " [SYNTHETIC]" if t.get('adjusted') else ""
-            print(f"  {i}. {t['side']} {t['symbol']}: qty={t['quantity']}{is_synth}")
+        # Log all trade quantities after FIFO
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("After FIFO - trade quantities:")
+            for i, t in enumerate(stock_trades):
+                logger.debug("  %d. %s %s: qty=%s%s", i, t.side, t.symbol, t.quantity, " [SYNTHETIC]" if t.adjusted else "")
 
         # Show remaining open positions
-        open_positions = {}
-        for symbol, queue in stock_positions.items():
-            if queue:
-                open_positions[symbol] = [
-                    {
-                        'quantity': t['quantity'],
-                        'amount': t['amount'],
-                        'original_amount': t.get('original_amount', t['amount']),
-                        'cost_adjustment': t.get('cost_adjustment', 0),
-                        'description': t['description']
-                    }
-                    for t in queue
-                ]
+        # Every queued trade carries original_amount/cost_adjustment (set when parsed or synthesized)
+        open_positions = {
+            symbol: [
+                {
+                    'quantity': t.quantity,
+                    'amount': t.amount,
+                    'original_amount': t.original_amount,
+                    'cost_adjustment': t.cost_adjustment,
+                    'description': t.description
+                }
+                for t in queue
+            ]
+            for symbol, queue in stock_positions.items()
+            if queue
+        }
 
         return jsonify({
             'assignment_adjustments': assignment_adjustments,
@@ -887,30 +1086,27 @@ def debug_raw_history():
         token = get_access_token()
         account_id = get_account_id(token)
 
-        now = datetime.now()
-        year_start = datetime(now.year, 1, 1).strftime('%Y-%m-%dT%H:%M:%SZ')
-        end_date = now.strftime('%Y-%m-%dT%H:%M:%SZ')
+        now = datetime.now(timezone.utc)
+        year_start = year_start_timestamp(now.year)
+        end_date = day_end_timestamp(now)
 
         # Fetch raw History API
         history = fetch_order_history(token, account_id, year_start, end_date)
         all_transactions = history.get('transactions', [])
 
-        # Filter to only TRADE transactions
-        trade_transactions = []
+        # Filter to TRADE transactions and group by symbol/contract in one pass
+        by_symbol = {}
+        all_trade_txs = []
         for tx in all_transactions:
-            tx_type = tx.get('type', '')
-            sub_type = tx.get('subType', '')
-            if tx_type == 'TRADE' and sub_type == 'TRADE':
-                trade_transactions.append(tx)
+            if tx.get('type', '') != 'TRADE' or tx.get('subType', '') != 'TRADE':
+                continue
 
-        # Group by symbol/contract
-        by_symbol = {}
-        for tx in trade_transactions:
             desc = tx.get('description', '')
             net_amount = float(tx.get('netAmount') or 0)
+            all_trade_txs.append({'desc': desc[:80], 'amount': float(tx.get('netAmount', 0))})
 
             # Try to match option
-            match = re.search(r'([A-Z]+2\d{2}\d{3}[CP]\d{8})', desc)
+            match = _DEBUG_OPTION_CONTRACT_RE.search(desc)
             if match:
                 key = match.group(1)
             else:
@@ -920,7 +1116,7 @@ def debug_raw_history():
 
             if key not in by_symbol:
                 by_symbol[key] = {'buy': 0, 'sell': 0, 'count': 0, 'txs': []}
-            if 'BUY' in desc:
+            if desc.startswith('BUY'):
                 by_symbol[key]['buy'] += net_amount
             else:
                 by_symbol[key]['sell'] += net_amount
@@ -929,9 +1125,9 @@ def debug_raw_history():
 
         return jsonify({
             'total_transactions': len(all_transactions),
-            'trade_transactions': len(trade_transactions),
+            'trade_transactions': len(all_trade_txs),
             'by_symbol': by_symbol,
-            'all_trade_txs': [{'desc': tx.get('description', '')[:80], 'amount': float(tx.get('netAmount', 0))} for tx in trade_transactions]
+            'all_trade_txs': all_trade_txs
         })
     except Exception as e:
         import traceback
@@ -945,20 +1141,17 @@ def debug_all_positions():
         token = get_access_token()
         account_id = get_account_id(token)
 
-        now = datetime.now()
-        year_start = datetime(now.year, 1, 1).strftime('%Y-%m-%dT%H:%M:%SZ')
-        end_date = now.strftime('%Y-%m-%dT%H:%M:%SZ')
-
-        # Fetch History API (YTD transactions)
-        history = fetch_order_history(token, account_id, year_start, end_date)
-        transactions = history.get('transactions', [])
+        now = datetime.now(timezone.utc)
+        year_start = year_start_timestamp(now.year)
+        end_date = day_end_timestamp(now)
 
-        # Fetch Portfolio API (current open positions)
-        portfolio_response = get(
-            f'https://api.public.com/userapigateway/trading/{account_id}/portfolio',
-            headers={'Authorization': f'Bearer {token}'}
-        )
-        portfolio = portfolio_response.json()
+        # Fetch Portfolio API (current open positions) in the background
+        # while History API (YTD transactions) is fetched
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            portfolio_future = pool.submit(fetch_portfolio, token, account_id)
+            history = fetch_order_history(token, account_id, year_start, end_date)
+            transactions = history.get('transactions', [])
+            portfolio = portfolio_future.result()
 
         # Extract currently open option positions from Portfolio
         open_in_portfolio = set()
@@ -966,7 +1159,7 @@ def debug_all_positions():
             for pos in portfolio['positions']:
                 symbol = pos.get('symbol', '')
                 # Option symbols have format like "NVDA260130P00065000"
-                if re.match(r'[A-Z]+2\d{2}\d{3}[CP]\d{8}', symbol):
+                if _DEBUG_OPTION_CONTRACT_RE.match(symbol):
                     open_in_portfolio.add(symbol)
 
         # Group all trades by contract
@@ -982,7 +1175,7 @@ def debug_all_positions():
             description = tx.get('description', '')
 
             # Try to match any option (not just 260)
-            match = re.search(r'([A-Z]+2\d{2}\d{3}[CP]\d{8})', description)
+            match = _DEBUG_OPTION_CONTRACT_RE.search(description)
             if match:
                 contract = match.group(1)  # Option contract
             else:
@@ -991,9 +1184,9 @@ def debug_all_positions():
                 contract = parts[2] if len(parts) > 2 else 'UNKNOWN'
 
             if contract not in all_trades:
-                all_trades[contract] = {'buy': 0, 'sell': 0, 'count': 0, 'sample': '', 'in_portfolio': contract in open_in_portfolio}
+                all_trades[contract] = {'buy': 0, 'sell': 0, 'count': 0, 'sample': ''}
 
-            if 'BUY' in description:
+            if description.startswith('BUY'):
                 all_trades[contract]['buy'] += net_amount
             else:
                 all_trades[contract]['sell'] += net_amount
@@ -1001,19 +1194,29 @@ def debug_all_positions():
             all_trades[contract]['count'] += 1
             all_trades[contract]['sample'] = description
 
-        # Categorize
-        closed = {k: v for k, v in all_trades.items() if v['buy'] != 0 and v['sell'] != 0}
-        only_buy = {k: v for k, v in all_trades.items() if v['buy'] != 0 and v['sell'] == 0}
-        only_sell = {k: v for k, v in all_trades.items() if v['buy'] == 0 and v['sell'] != 0}
-
-        # Further categorize only_sell by whether they're in portfolio
-        only_sell_open = {k: v for k, v in only_sell.items() if v.get('in_portfolio', False)}
-        only_sell_not_in_portfolio = {k: v for k, v in only_sell.items() if not v.get('in_portfolio', False)}
-
-        closed_pl = sum(v['buy'] + v['sell'] for v in closed.values())
-        only_buy_pl = sum(v['buy'] for v in only_buy.values())
-        only_sell_pl = sum(v['sell'] for v in only_sell.values())
-        only_sell_not_in_portfolio_pl = sum(v['sell'] for v in only_sell_not_in_portfolio.values())
+        # Contracts traded this year that are still open (C-level set intersection)
+        live_contracts = open_in_portfolio & all_trades.keys()
+
+        # Categorize (and total) every contract in a single walk
+        closed, only_buy, only_sell_open, only_sell_not_in_portfolio = {}, {}, {}, {}
+        closed_pl = only_buy_pl = only_sell_open_pl = only_sell_not_in_portfolio_pl = 0
+        for k, v in all_trades.items():
+            v['in_portfolio'] = in_portfolio = k in live_contracts
+            buy, sell = v['buy'], v['sell']
+            if buy != 0 and sell != 0:
+                closed[k] = v
+                closed_pl += buy + sell
+            elif buy != 0:
+                only_buy[k] = v
+                only_buy_pl += buy
+            elif sell != 0:
+                # Sell-only: split by whether the contract is still in the portfolio
+                if in_portfolio:
+                    only_sell_open[k] = v
+                    only_sell_open_pl += sell
+                else:
+                    only_sell_not_in_portfolio[k] = v
+                    only_sell_not_in_portfolio_pl += sell
 
         # Calculate what happens if we add sell-only that are NOT in portfolio (likely expired)
         with_expired_pl = closed_pl + only_sell_not_in_portfolio_pl
@@ -1032,7 +1235,7 @@ def debug_all_positions():
             },
             'only_sell_open_in_portfolio': {
                 'count': len(only_sell_open),
-                'total_pl': sum(v['sell'] for v in only_sell_open.values()),
+                'total_pl': only_sell_open_pl,
                 'positions': only_sell_open
             },
             'only_sell_not_in_portfolio': {